@@ -1,10 +1,15 @@
+import argparse
 import datetime
+import hashlib
 import os
+import posixpath
 import re
-import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
-import mistune
+from markdown_it import MarkdownIt
+from mdit_py_plugins.footnote import footnote_plugin
 from typing import Tuple
 
 import support
@@ -13,57 +18,121 @@ default_config = {
     'site_path': 'site',
     'target_path': 'target',
     'document_path': 'document',
+    'cache_path': '.jinja-cache',
 }
 
 config = support.load_config(default_config)
 site_path = Path(config['site_path'])
 target_path = Path(config['target_path'])
-env = support.build_template_environment(site_path)
+SITE = os.fspath(site_path.resolve())
+TARGET = os.fspath(target_path.resolve())
+CURRENT = Path('.')
+env = support.build_template_environment(site_path, config['cache_path'])
 logger = support.build_logger()
 
+BUILD_CACHE = target_path / '.build-cache.json'
+STATIC_WORKERS = 16
+PAGE_CHUNK = 8
 TEMPLATE_EXT = ('.html', '.htm')
 MARKDOWN_EXT = ('.markdown', '.md')
 
+templates = dict()
+layouts = dict()
+
+
+def compile_template(source: str):
+    key = hashlib.blake2b(source.encode('utf-8'), digest_size=8).digest()
+    if key not in templates:
+        templates[key] = env.from_string(source)
+    return templates[key]
+
+
+def layout_template(layout: str):
+    if layout not in layouts:
+        layouts[layout] = env.get_template('_layout/{}.html'.format(layout))
+    return layouts[layout]
+
+
+worker_site = None
+
+
+def init_worker(site):
+    global worker_site
+    worker_site = site
+
+
+def build_page(page):
+    return page.build(worker_site)
+
 
 class Markdown:
-    META_SEPARATOR = re.compile(r"^---\n(.*)---\n", re.DOTALL)
+    INLINE_SYNTAX = re.compile(r'[\\`*_\[\]<>&"!~:\n]|^\s|\s$')
+    INFO_KEYS = ('title', 'excerpt')
+    local = threading.local()
 
-    class Renderer(mistune.Renderer):
-        info = dict()
+    @staticmethod
+    def heading_open(renderer, tokens, idx, options, env):
+        text = renderer.renderInline(tokens[idx + 1].children, options, env)
+        if tokens[idx].tag == 'h1':
+            env['title'] = text
+        tokens[idx].attrSet('id', support.url_escape(text))
+        return renderer.renderToken(tokens, idx, options, env)
 
-        def paragraph(self, text):
-            text = text.strip(' ')
-            if 'excerpt' not in self.info:
-                self.info['excerpt'] = text
-            return '<p>%s</p>\n' % text
+    @staticmethod
+    def del_open(renderer, tokens, idx, options, env):
+        return '<del>'
 
-        def header(self, text, level, raw=None):
-            if level == 1:
-                self.info['title'] = text
-            escape = support.url_escape(text)
-            return '<h{0} id="{2}">{1}</h{0}>\n'.format(level, text, escape)
+    @staticmethod
+    def del_close(renderer, tokens, idx, options, env):
+        return '</del>'
 
     def __init__(self):
-        self.renderer = Markdown.Renderer()
-        self.markdown = mistune.Markdown(renderer=self.renderer)
+        self.markdown = MarkdownIt('commonmark', {'langPrefix': 'lang-', 'linkify': True})
+        self.markdown.enable(['table', 'strikethrough', 'linkify']).use(footnote_plugin)
+        self.markdown.linkify.set({'fuzzy_link': False, 'fuzzy_email': False})
+        self.markdown.add_render_rule('heading_open', Markdown.heading_open)
+        self.markdown.add_render_rule('s_open', Markdown.del_open)
+        self.markdown.add_render_rule('s_close', Markdown.del_close)
 
     def render(self, text):
-        searched = self.META_SEPARATOR.search(text)
+        front_matter, text = support.split_front_matter(text)
         meta = dict()
-        if searched:
-            text = text[searched.end():]
-            meta = support.yaml_load(searched.group(1))
-            if 'excerpt' in meta:
-                meta['excerpt'] = self.markdown.render(meta['excerpt'])
-        self.renderer.info.clear()
-        result = self.markdown.render(text)
-        info = self.renderer.info.copy()
-        self.renderer.info.clear()
+        if front_matter is not None:
+            meta = support.front_matter_load(front_matter)
+        env = dict()
+        tokens = self.markdown.parse(text, env)
+        source = self.capture_excerpt(tokens, env)
+        result = self.markdown.renderer.render(tokens, self.markdown.options, env)
+        info = {key: env[key] for key in self.INFO_KEYS if key in env}
+        if meta.get('excerpt'):
+            excerpt = str(meta['excerpt'])
+            if excerpt.strip() == source:
+                del meta['excerpt']
+            else:
+                meta['excerpt'] = self.render_excerpt(excerpt)
         info.update(meta)
         return result, info
 
+    def capture_excerpt(self, tokens, info):
+        for idx, token in enumerate(tokens):
+            if token.type == 'paragraph_open' and not token.hidden:
+                inline = tokens[idx + 1]
+                text = self.markdown.renderer.renderInline(
+                    inline.children, self.markdown.options, info)
+                info['excerpt'] = text.strip(' ')
+                return inline.content
+        return None
+
+    def render_excerpt(self, excerpt):
+        if self.INLINE_SYNTAX.search(excerpt):
+            return self.markdown.renderInline(excerpt)
+        return excerpt
 
-markdown = Markdown()
+    @classmethod
+    def get(cls):
+        if not hasattr(cls.local, 'markdown'):
+            cls.local.markdown = cls()
+        return cls.local.markdown
 
 
 class Site:
@@ -82,50 +151,112 @@ class Site:
                     self.pages.append(Page(file, path))
                 else:
                     self.statics.append(Static(file, path))
+        resources = self.pages + self.statics
+        self.output_dirs = {os.path.dirname(resource.output_path) for resource in resources}
+        self.outputs = support.list_files(self.output_dirs)
+
+        self.cache = support.load_build_cache(BUILD_CACHE)
+        self.records = dict()
+        templates = sorted(Site.template_files())
+        self.templates_stamp = support.fingerprint(
+            [Path('config.yaml').stat().st_mtime_ns] +
+            [(str(path), path.stat().st_mtime_ns) for path in templates])
+        self.site_stamp = support.fingerprint(
+            [self.templates_stamp] +
+            [(resource.source_path, resource.key) for resource in resources])
+
+        for key, value in config.items():
+            if not hasattr(self, key):
+                setattr(self, key, value)
+
+    def build(self, jobs=None):
+        for directory in self.output_dirs:
+            os.makedirs(directory, exist_ok=True)
+        pages = [page for page in self.pages if not self.is_fresh(page)]
+        statics = [static for static in self.statics if not self.is_fresh(static)]
+        if jobs == 1:
+            outputs = [page.build(self) for page in pages]
+            for static in statics:
+                static.build()
+        else:
+            chunks = -(-len(pages) // PAGE_CHUNK)
+            workers = max(1, min(jobs or os.cpu_count() or 1, chunks))
+            # Fork the page workers before any copy thread is started.
+            processes = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(self,))
+            with processes, ThreadPoolExecutor(STATIC_WORKERS) as threads:
+                builds = processes.map(build_page, pages, chunksize=PAGE_CHUNK)
+                copies = threads.map(Static.build, statics)
+                outputs = list(builds)
+                list(copies)
+        for page, output in zip(pages, outputs):
+            self.record(page, output)
+        for static in statics:
+            self.record(static, None)
+
+    def is_fresh(self, resource):
+        record = self.cache.get(resource.source_path)
+        if record is None or record['key'] != resource.key:
+            return False
+        if record['stamp'] != resource.stamp(self) or resource.output_path not in self.outputs:
+            return False
+        self.records[resource.source_path] = record
+        return True
+
+    def record(self, resource, output):
+        self.records[resource.source_path] = {
+            'key': resource.key,
+            'stamp': resource.stamp(self),
+            'output': output,
+        }
 
-    def build(self):
-        for page in self.pages:
-            page.build(self)
-        for static in self.statics:
-            static.build()
+    def save_cache(self):
+        support.dump_build_cache(BUILD_CACHE, self.records)
+
+    @staticmethod
+    def template_files():
+        for entry in site_path.iterdir():
+            if not Site.is_ignore(entry.name):
+                continue
+            if entry.is_dir():
+                yield from (path for path in entry.rglob('*') if path.is_file())
+            else:
+                yield entry
 
     @staticmethod
     def is_ignore(name: str):
         return name.startswith('_')
 
-    def __getattr__(self, item):
-        if item not in config:
-            raise AttributeError
-        else:
-            return config[item]
-
 
 class Resource:
+    __slots__ = ('filename', 'output_name', 'location', 'url',
+                 'source_path', 'output_path', 'stat', 'key')
+
     def __init__(self, filename: Path, relative: Path, output_name=None):
+        relative = '' if relative == CURRENT else str(relative)
         self.filename = filename
-        self.output_name = output_name or filename
-        self.location = site_path / relative
+        self.output_name = str(output_name or filename)
+        self.location = os.path.join(SITE, relative)
 
         base = config['base_url'] if 'base_url' in config else '/'
-        self.url = base / relative / output_name
+        self.url = posixpath.join(base, relative, self.output_name)
+
+        self.source_path = os.path.join(self.location, str(filename))
+        self.output_path = os.path.join(TARGET, relative, self.output_name)
 
-        self.source_path = self.location / filename
-        self.output_path = target_path / relative / self.output_name
+        self.stat = os.stat(self.source_path)
+        self.key = [self.stat.st_mtime_ns, self.stat.st_size]
+
+    def stamp(self, site):
+        return ''
 
     def read(self):
-        with open(self.source_path, encoding='utf-8') as file:
-            return file.read()
+        return Path(self.source_path).read_text(encoding='utf-8')
 
     def write(self, data):
-        if not self.output_path.parent.exists():
-            os.makedirs(self.output_path.parent)
-        with open(self.output_path, mode='w', encoding='utf-8') as file:
-            file.write(data)
+        Path(self.output_path).write_text(data, encoding='utf-8')
 
 
 class Page(Resource):
-    POST_PATTERN = re.compile(r'^(\d+)-(\d+)-(\d+)-.+')
-
     def __init__(self, filename: Path, relative: Path):
         super().__init__(filename, relative, '{}.html'.format(filename.stem))
 
@@ -147,56 +278,85 @@ class Page(Resource):
             self.title = self.meta['title']
         else:
             self.title = str(filename.stem)
-
-    def __getattr__(self, item):
-        if item not in self.meta:
-            raise AttributeError
-        else:
-            return self.meta[item]
+        for key, value in self.meta.items():
+            if not hasattr(self, key):
+                setattr(self, key, value)
 
     def page_type_and_creation(self, filename) -> Tuple[bool, datetime.datetime]:
-        filename = str(filename)
-        match = self.POST_PATTERN.match(filename)
-        if match:
-            year = match.group(1)
+        parts = str(filename).split('-', 3)
+        if len(parts) == 4 and parts[3] and all(part.isdecimal() for part in parts[:3]):
+            year, month, day = parts[:3]
             if len(year) == 2:
-                year = int('20' + year)
-            month = int(match.group(2))
-            day = int(match.group(3))
-            return True, datetime.datetime(year, month, day)
+                year = '20' + year
+            return True, datetime.datetime(int(year), int(month), int(day))
         else:
-            return False, support.creation_time(self.source_path)
+            return False, support.creation_time(self.stat)
 
     def render(self):
         source = self.read()
         if self.markdown:
-            source, context = markdown.render(source)
+            source, context = Markdown.get().render(source)
             self.meta.update(context)
-        if self.meta['layout']:
-            source = """{{% extends "_layout/{layout}.html" %}}
-            {{% block content %}}{content}{{% endblock %}}""".format(
-                layout=self.meta['layout'], content=source)
         return source
 
+    def stamp(self, site):
+        return site.site_stamp
+
     def build(self, site):
         if not self.meta['published']:
-            return
-        template = env.from_string(self.source)
-        self.write(template.render(self.meta, page=self, site=site))
+            return None
+        if self.meta['layout']:
+            template = env.get_template(support.CONTENT_WRAPPER)
+            layout = layout_template(self.meta['layout'])
+            # Jinja drops one trailing newline; the body used to sit inside a larger template.
+            body = compile_template(self.source + '\n')
+            content = body.render(self.meta, page=self, site=site)
+            result = template.render(self.meta, page=self, site=site,
+                                     layout_template=layout, content=content)
+        else:
+            template = compile_template(self.source)
+            result = template.render(self.meta, page=self, site=site)
+        output = hashlib.blake2b(result.encode('utf-8'), digest_size=16).hexdigest()
+        record = site.cache.get(self.source_path, {})
+        if record.get('output') != output or self.output_path not in site.outputs:
+            self.write(result)
+        return output
 
 
 class Static(Resource):
+    __slots__ = ()
+
     def __init__(self, filename, relative):
         super().__init__(filename, relative)
 
     def build(self):
-        shutil.copy(str(self.source_path), str(self.output_path))
+        support.copy_file(self.source_path, self.output_path, self.stat.st_size)
 
 
-def generate():
+def generate(jobs=None):
     site = Site()
-    site.build()
+    site.build(jobs)
+    site.save_cache()
+
+
+def positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be a positive integer, got {!r}'.format(value))
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Another static site generator.')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=None,
+                        help='number of parallel build jobs, 1 builds serially '
+                             '(default: number of CPUs)')
+    args = parser.parse_args()
+    generate(args.jobs)
 
 
 if __name__ == '__main__':
-    generate()
+    main()
@@ -1,35 +1,120 @@
 import datetime
+import errno
+import hashlib
+import json
 import logging
 import os
-import time
+import shutil
+import string
+import sys
 import urllib.parse
 from pathlib import Path
 
 import jinja2
 import yaml
-from typing import Callable, Tuple, List, Iterable
+from typing import Callable, Tuple, List, Iterable, Optional
 
 try:
-    from yaml import CLoader as Loader, CDumper as Dumper
+    from yaml import CSafeLoader as Loader, CDumper as Dumper
 except ImportError:
-    from yaml import Loader, Dumper
+    from yaml import SafeLoader as Loader, Dumper
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+if hasattr(fcntl, 'FICLONE'):
+    FICLONE = fcntl.FICLONE
+elif fcntl is not None and sys.platform.startswith('linux'):
+    FICLONE = 0x40049409
+else:
+    FICLONE = None
+CLONE_UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS)
+SENDFILE_UNSUPPORTED = (errno.EINVAL, errno.ENOTSOCK, errno.ENOSYS, errno.EOPNOTSUPP)
+SENDFILE_THRESHOLD = 64 * 1024
+URL_SAFE = frozenset(string.ascii_letters + string.digits + '_.-~/')
+URL_ESCAPE_TABLE = {
+    code: chr(code).lower() if chr(code) in URL_SAFE else '%{:02X}'.format(code)
+    for code in range(128)
+}
+URL_ESCAPE_TABLE[ord(' ')] = '_'
 
 
 def yaml_load(stream) -> dict:
     return yaml.load(stream, Loader=Loader)
 
 
+def split_front_matter(text: str) -> Tuple[Optional[str], str]:
+    if not text.startswith('---\n'):
+        return None, text
+    end = text.find('\n---\n', 3)
+    if end < 0:
+        return None, text
+    return text[4:end + 1], text[end + 5:]
+
+
+def front_matter_load(text: str) -> dict:
+    stripped = text.strip()
+    if orjson is not None and stripped.startswith('{'):
+        try:
+            return orjson.loads(stripped)
+        except orjson.JSONDecodeError:
+            pass
+    return yaml_load(text) or dict()
+
+
 def yaml_dump(obj: dict) -> str:
     return yaml.dump(obj, Dumper=Dumper)
 
 
-def build_template_environment(templates_path) -> jinja2.Environment:
+CONTENT_WRAPPER = '_content_wrapper.html'
+
+
+def build_template_environment(templates_path, cache_path) -> jinja2.Environment:
+    os.makedirs(str(cache_path), exist_ok=True)
+    wrapper = jinja2.DictLoader({
+        CONTENT_WRAPPER: '{% extends layout_template %}'
+                         '{% block content %}{{ content|safe }}{% endblock %}',
+    })
     return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(str(templates_path)),
+        loader=jinja2.ChoiceLoader([
+            wrapper,
+            jinja2.FileSystemLoader(str(templates_path)),
+        ]),
         lstrip_blocks=True,
+        bytecode_cache=jinja2.FileSystemBytecodeCache(str(cache_path)),
+        auto_reload=False,
     )
 
 
+def load_build_cache(path) -> dict:
+    try:
+        with open(str(path), encoding='utf-8') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return dict()
+
+
+def dump_build_cache(path, cache: dict):
+    os.makedirs(os.path.dirname(str(path)) or os.curdir, exist_ok=True)
+    with open(str(path), mode='w', encoding='utf-8') as cache_file:
+        json.dump(cache, cache_file)
+
+
+def fingerprint(parts: Iterable) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(repr(part).encode('utf-8'))
+    return digest.hexdigest()
+
+
 def load_config(default: dict) -> dict:
     config_file_name = 'config.yaml'
     with open(config_file_name) as config_file:
@@ -46,17 +131,76 @@ def build_logger() -> logging.Logger:
 
 
 def walk(path, is_ignore: Callable[[str], bool]) -> Iterable[Tuple[Path, List[Path]]]:
-    for (root, dirs, files) in os.walk(path):
-        dirs[:] = [dir_name for dir_name in dirs if not is_ignore(dir_name)]
-        files = [Path(file) for file in files if not is_ignore(file)]
-        yield (Path(root).relative_to(path), files)
-
-
-def creation_time(path) -> datetime.datetime:
-    ctime = time.ctime(os.path.getctime(str(path)))
-    return datetime.datetime.strptime(ctime, "%a %b %d %H:%M:%S %Y")
+    path = Path(path)
+    stack = [path]
+    while stack:
+        root = stack.pop()
+        files = []
+        with os.scandir(str(root)) as entries:
+            for entry in entries:
+                if is_ignore(entry.name):
+                    continue
+                if not entry.is_dir():
+                    files.append(Path(entry.name))
+                elif not entry.is_symlink():
+                    stack.append(root / entry.name)
+        yield (root.relative_to(path), files)
+
+
+def list_files(directories: Iterable[str]) -> set:
+    files = set()
+    for directory in directories:
+        try:
+            with os.scandir(directory) as entries:
+                files.update(entry.path for entry in entries)
+        except FileNotFoundError:
+            continue
+    return files
+
+
+def creation_time(stat: os.stat_result) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(int(stat.st_ctime))
 
 
 def url_escape(s: str) -> str:
+    if s.isascii():
+        return s.translate(URL_ESCAPE_TABLE)
     s = s.replace(' ', '_').lower()
     return urllib.parse.quote(s)
+
+
+def clone_file(source_file, target_file) -> bool:
+    try:
+        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+        return True
+    except OSError as error:
+        if error.errno not in CLONE_UNSUPPORTED:
+            raise
+        return False
+
+
+def send_file(source_file, target_file, size: int) -> bool:
+    offset = 0
+    try:
+        while offset < size:
+            sent = os.sendfile(target_file.fileno(), source_file.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+        return True
+    except OSError as error:
+        if offset or error.errno not in SENDFILE_UNSUPPORTED:
+            raise
+        return False
+
+
+def copy_file(source, target, size: int):
+    with open(str(source), 'rb') as source_file, open(str(target), 'wb') as target_file:
+        if FICLONE is not None and clone_file(source_file, target_file):
+            return
+        if size < SENDFILE_THRESHOLD:
+            target_file.write(source_file.read())
+            return
+        if hasattr(os, 'sendfile') and send_file(source_file, target_file, size):
+            return
+    shutil.copyfile(str(source), str(target))